@@ -35,6 +35,10 @@ class LinearBase(metaclass=ABCMeta):
 
     def make_polynomial(self, X: np.ndarray) -> np.ndarray:
         degree, bias = self.degree, self.bias
+        # linear design matrix is just X with an optional column of ones
+        if degree == 1:
+            X = np.array(X, dtype=float)
+            return np.column_stack((np.ones(X.shape[0]), X)) if bias else X
         pf = PolynomialFeatures(degree=degree, include_bias=bias)
         return pf.fit_transform(X)
 
@@ -33,11 +33,172 @@ Notes:
 from __future__ import annotations
 from itertools import chain
 from marketlearn.toolz import timethis
+from typing import Tuple, Union
+from numba import njit
 from scipy.optimize import minimize
-from scipy.stats import norm
 import numpy as np
 import pandas as pd
 
+# fastmath flags without nnan/ninf, so inf and nan are handled as in numpy
+_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit(cache=True, fastmath=_FASTMATH, error_model="numpy")
+def _loglik(
+    obs: np.ndarray,
+    mu0: float,
+    mu1: float,
+    sig: float,
+    p11: float,
+    p22: float,
+    jac: bool,
+) -> tuple:
+    """Computes the mean loglikelihood and its score via hamilton's filter
+
+    The score is accumulated alongside the filter by differentiating
+    the filter recursion, where d(filter)/d(theta) is itself a recursion
+
+    Parameters
+    ----------
+    obs : np.ndarray
+        the observed response variable
+    mu0 : float
+        mean of regime 1
+    mu1 : float
+        mean of regime 2
+    sig : float
+        constant volatility of both regimes
+    p11 : float
+        probability that r.v that starts at regime 1, stays at regime 1
+    p22 : float
+        probability that r.v that starts at regime 2, stays at regime 2
+    jac : bool
+        whether to compute the score, if False the score is left at zero
+
+    Returns
+    -------
+    tuple
+        mean loglikelihood of data observed for t = 1,...,T
+        and its gradient wrt (p11, p22, mu0, mu1, sig)
+    """
+    n = obs.shape[0]
+    var = sig * sig
+    inv_2var = 0.5 / var
+    log_scale = -0.5 * np.log(2.0 * np.pi * var)
+
+    # start filter at the ergodic probabilities of the markov chain
+    denom = 2.0 - p11 - p22
+    f0 = (1.0 - p22) / denom
+
+    # derivatives of filter p(st=0|Ft), the other state is 1 - f0
+    df0 = np.zeros(5)
+    df0[0] = (1.0 - p22) / (denom * denom)
+    df0[1] = -(1.0 - p11) / (denom * denom)
+    de0 = np.empty(5)
+    de1 = np.empty(5)
+    score = np.zeros(5)
+    total = 0.0
+    for t in range(1, n):
+        # predictions p(st|Ft-1) given by P'filter
+        pr0 = p11 * f0 + (1.0 - p22) * (1.0 - f0)
+        pr1 = 1.0 - pr0
+
+        # joint density f(yt|st, Ft-1) * P(st|Ft-1) divided by
+        # scale * exp(amax) so the larger density never underflows
+        r0, r1 = obs[t] - mu0, obs[t] - mu1
+        a0, a1 = -r0 * r0 * inv_2var, -r1 * r1 * inv_2var
+        amax = max(a0, a1)
+        d0, d1 = np.exp(a0 - amax), np.exp(a1 - amax)
+        e0, e1 = pr0 * d0, pr1 * d1
+        # floor keeps log finite if both predictions vanish
+        loglik = max(e0 + e1, 1e-300)
+        total += np.log(loglik) + amax + log_scale
+        if not jac:
+            f0 = e0 / loglik
+            continue
+
+        # derivatives of scaled joint density through the predictions
+        for k in range(5):
+            dpr0 = (p11 + p22 - 1.0) * df0[k]
+            de0[k] = dpr0 * d0
+            de1[k] = -dpr0 * d1
+        de0[0] += f0 * d0
+        de1[0] -= f0 * d1
+        de0[1] -= (1.0 - f0) * d0
+        de1[1] += (1.0 - f0) * d1
+
+        # derivatives of joint density through the normal densities
+        de0[2] += e0 * r0 / var
+        de1[3] += e1 * r1 / var
+        de0[4] += e0 * (r0 * r0 / var - 1.0) / sig
+        de1[4] += e1 * (r1 * r1 / var - 1.0) / sig
+
+        # update the filter p(st|Ft), its derivatives and the score
+        f0 = e0 / loglik
+        for k in range(5):
+            dloglik = de0[k] + de1[k]
+            score[k] += dloglik / loglik
+            df0[k] = (de0[k] - f0 * dloglik) / loglik
+
+    return total / (n - 1), score / (n - 1)
+
+
+@njit(cache=True, fastmath=_FASTMATH, error_model="numpy")
+def _filter(
+    obs: np.ndarray,
+    mu0: float,
+    mu1: float,
+    sig: float,
+    p11: float,
+    p22: float,
+    hfilter: np.ndarray,
+    predict_prob: np.ndarray,
+):
+    """Computes hamilton's filter in place
+
+    Parameters
+    ----------
+    obs : np.ndarray
+        the observed response variable
+    mu0 : float
+        mean of regime 1
+    mu1 : float
+        mean of regime 2
+    sig : float
+        constant volatility of both regimes
+    p11 : float
+        probability that r.v that starts at regime 1, stays at regime 1
+    p22 : float
+        probability that r.v that starts at regime 2, stays at regime 2
+    hfilter : np.ndarray, shape=(n_samples, 2)
+        buffer the filtered probabilities p(st|Ft) are written to
+    predict_prob : np.ndarray, shape=(n_samples, 2)
+        buffer the predicted probabilities p(st|Ft-1) are written to
+    """
+    n = obs.shape[0]
+    inv_2var = 0.5 / (sig * sig)
+
+    # start filter at the ergodic probabilities of the markov chain
+    hfilter[0, 0] = (1.0 - p22) / (2.0 - p11 - p22)
+    hfilter[0, 1] = 1.0 - hfilter[0, 0]
+    predict_prob[0, 0] = predict_prob[0, 1] = 0.0
+    for t in range(1, n):
+        # predictions p(st|Ft-1) given by P'filter
+        pr0 = p11 * hfilter[t - 1, 0] + (1.0 - p22) * hfilter[t - 1, 1]
+        pr1 = (1.0 - p11) * hfilter[t - 1, 0] + p22 * hfilter[t - 1, 1]
+        predict_prob[t, 0], predict_prob[t, 1] = pr0, pr1
+
+        # joint density f(yt|st, Ft-1) * P(st|Ft-1) up to a common
+        # factor, scaled so the larger density never underflows
+        a0 = -((obs[t] - mu0) ** 2) * inv_2var
+        a1 = -((obs[t] - mu1) ** 2) * inv_2var
+        amax = max(a0, a1)
+        e0 = pr0 * np.exp(a0 - amax)
+        e1 = pr1 * np.exp(a1 - amax)
+        loglik = max(e0 + e1, 1e-300)
+        hfilter[t, 0] = e0 / loglik
+        hfilter[t, 1] = e1 / loglik
+
 
 class MarkovSwitchModel:
     """Implementation of Hamilton's Regime Switching Model
@@ -93,37 +254,13 @@ class MarkovSwitchModel:
         """
         return 1.0 / (1 + np.exp(-z))
 
-    def _normpdf(
-        self,
-        obs: np.ndarray,
-        mean: np.ndarray,
-        sigma: np.ndarray,
-    ) -> np.ndarray:
-        """Computes the normal density f(yt|st,Ft-1) of each observation
-
-        Parameters
-        ----------
-        obs : np.ndarray
-            observed response variable
-        mean : np.ndarray
-            the mean of two regimes
-        sigma : np.ndarray
-            the volatility of two regimes
-
-        Returns
-        -------
-        np.ndarray
-            normal density given the information set
-        """
-        lik = map(lambda x, y: norm(loc=x, scale=y).pdf(obs), mean, sigma)
-        return np.column_stack(tuple(lik))
-
     def _loglikelihood(
         self,
         obs: np.ndarray,
         theta: np.ndarray,
         store: bool = False,
-    ) -> np.ndarray:
+        jac: bool = False,
+    ) -> Union[float, Tuple[float, np.ndarray]]:
         """Computes the loglikelihood of data observed
 
         Parameters
@@ -134,65 +271,46 @@ class MarkovSwitchModel:
             initial guess for optimization
         store : bool, optional, default=False
             if true, store results of prediction and filtered probabilities
+        jac : bool, optional, default=False
+            if true, also return gradient of loglikelihood wrt theta
 
         Returns
         -------
-        np.ndarray
-            loglikelihood of data observed
+        Union[float, Tuple[float, np.ndarray]]
+            loglikelihood of data observed,
+            and its gradient as np.ndarray if jac is True
         """
         # get parameters from theta
-        prob = theta[:2]
-        means = theta[2:4]
-        sig = np.array([theta[-1], theta[-1]])
-
-        # step 1: initate starting values
-        n = obs.shape[0]
-        hfilter = np.zeros((n, self.nregime))
-        eta = np.zeros((n, self.nregime))
-        predict_prob = np.zeros((n, self.nregime))
-        # joint density f(yt|St, Ft-1) * P(st|Ft-1)
-        jointd = np.zeros(n)
+        p11, p22, mu0, mu1, sig = theta
+        pii, pjj = self._sigmoid(np.array([p11, p22]))
 
         # construct transition matrix
-        self._transition_matrix(*self._sigmoid(prob))
-
-        # initial guess for filter
-        hfilter[0] = np.array([0.5, 0.5])
-        predict_prob[1] = self.tr_matrix.T @ hfilter[0]
-
-        # compute the densities at t=1:T
-        eta = self._normpdf(obs, means, sig)
-
-        # step2: start filter for t = 1,...,T-1
-        for t in range(1, n - 1):
-            exponent = eta[t] * predict_prob[t]
-            loglik = exponent.sum()
-
-            # compute the joint density for t = 1,...,T-1
-            jointd[t] = loglik
-            hfilter[t] = exponent / loglik
-
-            # compute predictions for t = 2,...,T
-            predict_prob[t + 1] = self.tr_matrix.T @ hfilter[t]
-
-        # compute the filter and joint at time T
-        exponent = eta[-1] * predict_prob[-1]
-        loglik = exponent.sum()
-        jointd[-1] = loglik
-        hfilter[-1] = exponent / loglik
+        self._transition_matrix(pii, pjj)
 
         if store is True:
+            hfilter, predict_prob = self.hamilton_filter(
+                obs, theta, predict=True
+            )
             self.filtered_prob = hfilter
             self.predict_prob = predict_prob
 
         # compute and return loglikelihood of data observed
-        return np.log(jointd[1:]).mean()
+        obs = np.asarray(obs, dtype=np.float64)
+        loglik, score = _loglik(obs, mu0, mu1, sig, pii, pjj, jac)
+        if jac is False:
+            return loglik
+
+        # chain rule for transition probs given by sigmoid of theta
+        score[0] *= pii * (1 - pii)
+        score[1] *= pjj * (1 - pjj)
+        return loglik, score
 
     def hamilton_filter(
         self,
         obs: np.ndarray,
         theta: np.ndarray,
         predict: bool = False,
+        out: tuple = None,
     ) -> np.ndarray:
         """computes the hamilton filter
 
@@ -204,6 +322,9 @@ class MarkovSwitchModel:
             initial guess for optimization
         predict : bool, optional, default=False
             whether to store result of predicted probabilities
+        out : tuple, optional, default=None
+            pair of (n_samples, n_regime) buffers to write the filter
+            and predictions into, if None new arrays are allocated
 
         Returns
         -------
@@ -211,36 +332,21 @@ class MarkovSwitchModel:
             the hamilton filter
         """
         # get parameters from theta
-        prob = theta[:2]
-        means = theta[2:4]
-        sig = np.array([theta[-1], theta[-1]])
+        p11, p22, mu0, mu1, sig = theta
 
         # step 1: initate starting values
+        obs = np.asarray(obs, dtype=np.float64)
         n = obs.shape[0]
-        hfilter = np.zeros((n, self.nregime))
-        predict_prob = np.zeros((n, self.nregime))
+        if out is None:
+            out = np.empty((n, self.nregime)), np.empty((n, self.nregime))
+        hfilter, predict_prob = out
 
         # construct transition matrix
-        self._transition_matrix(*self._sigmoid(prob))
-
-        # initial guess to start the filter
-        hfilter[0] = np.array([0.5, 0.5])
-        predict_prob[1] = self.tr_matrix.T @ hfilter[0]
-
-        # compute the densities at t=1,..,T
-        eta = self._normpdf(obs, means, sig)
-
-        # step2: start filter for t =1,..., T-1
-        for t in range(1, n - 1):
-            exponent = eta[t] * predict_prob[t]
-            hfilter[t] = exponent / exponent.sum()
+        pii, pjj = self._sigmoid(np.array([p11, p22]))
+        self._transition_matrix(pii, pjj)
 
-            # compute predictions for t = 2,...,T
-            predict_prob[t + 1] = self.tr_matrix.T @ hfilter[t]
-
-        # compute the filter at time T
-        exponent = eta[-1] * predict_prob[-1]
-        hfilter[-1] = exponent / exponent.sum()
+        # step2: run the filter for t = 1,..., T
+        _filter(obs, mu0, mu1, sig, pii, pjj, hfilter, predict_prob)
 
         return hfilter if not predict else (hfilter, predict_prob)
 
@@ -248,8 +354,7 @@ class MarkovSwitchModel:
         self,
         guess: np.ndarray,
         obs: np.ndarray,
-        store: bool = False,
-    ) -> float:
+    ) -> Tuple[float, np.ndarray]:
         """the objective function to be minimized
 
         Parameters
@@ -258,16 +363,14 @@ class MarkovSwitchModel:
             initial guess for optimization
         obs : np.ndarray
             observed response variable
-        store : bool, optional
-            [description], by default False
 
         Returns
         -------
-        float
-            negative of loglikelihood to be minimized
+        Tuple[float, np.ndarray]
+            negative of loglikelihood to be minimized and its gradient
         """
-        f = self._loglikelihood(obs, theta=guess, store=store)
-        return -f
+        f, score = self._loglikelihood(obs, theta=guess, jac=True)
+        return -f, -score
 
     def _transition_matrix(self, pii: float, pjj: float):
         """computes transition matrix from state transition probabilities
@@ -290,16 +393,25 @@ class MarkovSwitchModel:
     def fit(
         self,
         obs: np.ndarray,
-        n_iter: int = 10,
+        n_iter: int = 30,
+        tol: float = 1e-4,
+        gamma: float = 1.5,
     ) -> MarkovSwitchModel:
         """fits a two state regime switching model
 
+        A few EM iterations are run first to get into the basin of the
+        maximum, then the loglikelihood is maximized with its gradient
+
         Parameters
         ----------
         obs : np.ndarray
             [description]
-        n_iter : int, optional, default=10
-            number of em iterations to perform
+        n_iter : int, optional, default=30
+            maximum number of em iterations to perform
+        tol : float, optional, default=1e-4
+            relative change in loglikelihood at which em stops
+        gamma : float, optional, default=1.5
+            step size of parameterized em, see fit_em
 
         Returns
         -------
@@ -307,8 +419,8 @@ class MarkovSwitchModel:
             [description]
         """
         # get the initial guess from em algorithm
-        self.fit_em(obs, n_iter=n_iter)
-        guess_params = self.em_params.tail(1).values.ravel()
+        self.fit_em(obs, n_iter=n_iter, tol=tol, gamma=gamma)
+        guess_params = self.em_params.iloc[-1].to_numpy(dtype=float, copy=True)
 
         # convert the first two parameters as they are transition probs
         guess_params[:2] = self.inv_sigmoid(guess_params[:2])
@@ -317,11 +429,14 @@ class MarkovSwitchModel:
         self.theta = minimize(
             self._objective_func,
             guess_params,
-            method="SLSQP",
-            options={"disp": True},
-            args=(obs, True),
+            method="L-BFGS-B",
+            jac=True,
+            args=(obs,),
         )["x"]
 
+        # store filtered and predicted probabilities at optimal parameters
+        self._loglikelihood(obs, self.theta, store=True)
+
         # compute the smoothed probabilities with final parameters
         self.smoothed_prob = self.kims_smoother(
             self.filtered_prob, self.predict_prob, self.tr_matrix
@@ -410,17 +525,14 @@ class MarkovSwitchModel:
         # -- initial values don't really matter since for
         # -- algorithm, we are starting at index 1
 
-        # calculate the joint, t from t=1
-        for t in range(1, n):
-            # for state (st-1=0, st=0) and (st-1=0, st=1)
-            qprob[t, :2] = (
-                P[0] * smooth_prob[t] * filter_prob[t - 1, 0] / predict_prob[t]
-            )
+        # calculate the joint for all t from t=1 at once
+        ratio = smooth_prob[1:] / predict_prob[1:]
 
-            # for state (st-1=1, st=0) and (st-1=1, st=1)
-            qprob[t, 2:] = (
-                P[1] * smooth_prob[t] * filter_prob[t - 1, 1] / predict_prob[t]
-            )
+        # for state (st-1=0, st=0) and (st-1=0, st=1)
+        qprob[1:, :2] = P[0] * ratio * filter_prob[:-1, 0, np.newaxis]
+
+        # for state (st-1=1, st=0) and (st-1=1, st=1)
+        qprob[1:, 2:] = P[1] * ratio * filter_prob[:-1, 1, np.newaxis]
 
         # return the full posterior probabilities
         return np.concatenate((smooth_prob, qprob), axis=1)
@@ -437,6 +549,7 @@ class MarkovSwitchModel:
         self,
         obs: np.ndarray,
         theta: np.ndarray,
+        out: tuple = None,
     ) -> np.ndarray:
         """computes the e-step in the EM algorithm
 
@@ -446,6 +559,8 @@ class MarkovSwitchModel:
             the observed response variable
         theta : np.ndarray
             intial guess in EM algorithm
+        out : tuple, optional, default=None
+            buffers for the hamilton filter and predictions
 
         Returns
         -------
@@ -453,7 +568,9 @@ class MarkovSwitchModel:
             the posterior probabilities computed in the e-step
         """
         # get hamilton filter and predictions
-        hfilter, predict_prob = self.hamilton_filter(obs, theta, predict=True)
+        hfilter, predict_prob = self.hamilton_filter(
+            obs, theta, predict=True, out=out
+        )
 
         # compute and return posterior prob of each observation
         return self._qprob(
@@ -491,7 +608,14 @@ class MarkovSwitchModel:
             var = qprob[1:, 0] * spread1 ** 2 + qprob[1:, 1] * spread2 ** 2
         return pkk, muk, [np.sqrt(var.mean())]
 
-    def fit_em(self, obs: np.ndarray, show: bool = False, n_iter: int = 10):
+    def fit_em(
+        self,
+        obs: np.ndarray,
+        show: bool = False,
+        n_iter: int = 10,
+        tol: float = 1e-4,
+        gamma: float = 1.0,
+    ):
         """fits a markov switching model via EM Algorithm
 
         Parameters
@@ -501,7 +625,13 @@ class MarkovSwitchModel:
         show : bool, optional, default=False
             if true, show iterations of EM
         n_iter : int, optional, default=10
-            number of EM iterations to perform
+            maximum number of EM iterations to perform
+        tol : float, optional, default=1e-4
+            stop once relative change in loglikelihood is below tol
+        gamma : float, optional, default=1.0
+            step size of parameterized EM, theta + gamma(theta_em - theta)
+            values above 1 overrelax the EM update and are only taken
+            when they improve on the plain EM update
 
         Returns
         -------
@@ -518,22 +648,40 @@ class MarkovSwitchModel:
         muk = obs[idx]
         # ensures the transition probabilities are 0.5 each
         pk = np.zeros(n_regime)
-        theta = [0] * n_iter
         sig = np.ones(1)
+        theta = [np.concatenate((pk, muk, sig))]
+        loglik = self._loglikelihood(obs, theta[0])
+
+        # filter and predictions are reused across em iterations
+        buffers = np.empty((n, n_regime)), np.empty((n, n_regime))
 
         # iterate
         for i in range(n_iter):
-            theta[i] = np.concatenate((pk, muk, sig))
             if show:
-                items = chain(self._sigmoid(pk), muk, sig)
+                items = chain(self._sigmoid(theta[i][:2]), theta[i][2:])
                 print(f"#{i} ", ", ".join(f"{c:.4f}" for c in items))
 
             # compute the e-step
-            qprob = self._estep(obs, theta[i])
+            qprob = self._estep(obs, theta[i], out=buffers)
 
             # compute the m-step
             pkk, muk, sig = self._mstep(obs, qprob)
-            pk = self.inv_sigmoid(pkk)
+            theta_em = np.concatenate((self.inv_sigmoid(pkk), muk, sig))
+            new_loglik = self._loglikelihood(obs, theta_em)
+
+            # take the overrelaxed step if it beats the em update
+            if gamma != 1.0:
+                theta_acc = theta[i] + gamma * (theta_em - theta[i])
+                acc_loglik = self._loglikelihood(obs, theta_acc)
+                if acc_loglik > new_loglik:
+                    theta_em, new_loglik = theta_acc, acc_loglik
+            theta.append(theta_em)
+
+            # check for convergence
+            converged = abs(new_loglik - loglik) <= tol * abs(loglik)
+            loglik = new_loglik
+            if converged:
+                break
 
         cols = self._make_titles()
         self.em_params = pd.DataFrame(theta, columns=cols)
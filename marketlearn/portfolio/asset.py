@@ -1,8 +1,7 @@
 """Implementation of Asset class"""
 
 from __future__ import annotations
-from functools import lru_cache
-from numpy import array, cov, isnan, log
+from numpy import cov, empty, float64, isnan, log1p, nanmean, nansum, ndarray
 from typing import Tuple
 import pandas as pd
 
@@ -14,25 +13,47 @@ class Asset:
 
     __TRADING_DAYS_PER_YEAR = 252
 
-    def __init__(self, name: str, price_history: pd.Series):
-        """default constructor used to initialize Asset Class"""
+    def __init__(
+        self,
+        name: str,
+        price_history: pd.Series,
+        returns_history: ndarray = None,
+    ):
+        """default constructor used to initialize Asset Class
+
+        returns_history, if given, are precomputed log returns of
+        price_history whose first entry is nan, e.g a column view
+        of a portfolio's returns matrix
+        """
         self.name = name
         self.price_history = price_history
         self.size = price_history.shape[0]
-        self.returns_history = log(1 + self.price_history.pct_change())
-        self.annualized_returns = self.returns_history.sum()
+        # log returns as float64, first entry is always nan
+        if returns_history is None:
+            returns_history = log1p(
+                price_history.pct_change().to_numpy(dtype=float64)
+            )
+        self._returns_arr = returns_history
+        self.annualized_returns = nansum(self._returns_arr)
         self.expected_returns = self._get_expected_returns()
         self.__class__.all_assets.append(self)
 
     def _get_expected_returns(self):
-        return Asset.get_annualization_factor() * self.returns_history.mean()
+        return Asset.get_annualization_factor() * nanmean(self._returns_arr)
+
+    @property
+    def returns_history(self) -> pd.Series:
+        """log returns of asset indexed by dates of price history"""
+        return pd.Series(
+            self._returns_arr, index=self.price_history.index, name=self.name
+        )
 
     @staticmethod
     def get_annualization_factor():
         return Asset.__TRADING_DAYS_PER_YEAR
 
     def __hash__(self):
-        """allows hashing for lru_cache
+        """allows hashing of assets
 
         Returns
         -------
@@ -53,7 +74,6 @@ class Asset:
         \nannualized_returns: {self.annualized_returns:.5f}"
 
     @staticmethod
-    @lru_cache
     def covariance_matrix(assets: Tuple[Asset]):
         """computes the covariance matrix given tuple of assets
 
@@ -63,12 +83,32 @@ class Asset:
             Assets whose covariance we want to compute
 
         Returns
-        -------ß
+        -------
         np.ndarray
             covariance matrix of assets
         """
-        zt = array([a.returns_history for a in assets]).T
-        return (
-            cov(zt[~isnan(zt).any(axis=1)], rowvar=False)
-            * Asset.get_annualization_factor()
-        )
+        # skip the leading nan from pct_change, shape=(n_samples, n_assets)
+        zt = empty((assets[0].size - 1, len(assets)))
+        for j, asset in enumerate(assets):
+            zt[:, j] = asset._returns_arr[1:]
+        return Asset.returns_covariance_matrix(zt)
+
+    @staticmethod
+    def returns_covariance_matrix(zt: ndarray) -> ndarray:
+        """computes the annualized covariance matrix of log returns
+
+        Parameters
+        ----------
+        zt : ndarray, shape=(n_samples, n_assets)
+            log returns of each asset, one column per asset
+
+        Returns
+        -------
+        ndarray
+            covariance matrix of assets
+        """
+        # drop any dates where an asset has no return
+        missing = isnan(zt).any(axis=1)
+        if missing.any():
+            zt = zt[~missing]
+        return cov(zt, rowvar=False) * Asset.get_annualization_factor()
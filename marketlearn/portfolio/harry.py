@@ -6,8 +6,9 @@ Created Feb 10 2021
 
 from __future__ import annotations
 from marketlearn.portfolio import Asset
-from numpy import diag, fromiter, sqrt
-from numpy.random import random
+from numba import njit, prange
+from numpy import diag, sqrt
+from scipy.linalg import LinAlgError, cho_solve, cholesky, get_lapack_funcs
 from scipy.optimize import minimize
 import matplotlib.pyplot as plt
 import numpy as np
@@ -15,6 +16,49 @@ import pandas as pd
 
 # import plotly.graph_objects as go
 
+_rng = np.random.default_rng()
+
+# lapack solver for Ax = b, skips the validation done by linalg wrappers
+_gesv = get_lapack_funcs("gesv", (np.empty((1, 1)),))
+
+# fastmath flags without nnan/ninf, so inf and nan are handled as in numpy
+_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit(parallel=True, fastmath=_FASTMATH, cache=True)
+def _simulated_var_ret(weights: np.ndarray, cov: np.ndarray, mu: np.ndarray):
+    """computes variance and mean of each simulated portfolio in parallel
+
+    Parameters
+    ----------
+    weights : np.ndarray, shape=(n_portfolios, n_assets)
+        random weights of each simulated portfolio
+    cov : np.ndarray, shape=(n_assets, n_assets)
+        covariance matrix of assets
+    mu : np.ndarray, shape=(n_assets,)
+        expected returns of assets
+
+    Returns
+    -------
+    tuple
+        variance and expected return of each simulated portfolio
+    """
+    nportfolios, nsec = weights.shape
+    variances = np.empty(nportfolios)
+    means = np.empty(nportfolios)
+    for p in prange(nportfolios):
+        var, mean = 0.0, 0.0
+        for i in range(nsec):
+            # i'th element of cov(R)w
+            sw = 0.0
+            for j in range(nsec):
+                sw += cov[i, j] * weights[p, j]
+            var += weights[p, i] * sw
+            mean += weights[p, i] * mu[i]
+        variances[p] = var
+        means[p] = mean
+    return variances, means
+
 
 class Harry:
     """
@@ -37,17 +81,36 @@ class Harry:
 
     def __init__(self, historical_prices: pd.DataFrame, risk_free_rate=None):
         """Default constructor used to initialize portfolio"""
+        # log returns of all assets in one pass, first row is always nan
+        returns = np.log1p(
+            historical_prices.pct_change().to_numpy(dtype=np.float64)
+        )
+        self._returns_matrix = returns[1:]
+        self.asset_expected_returns = Asset.get_annualization_factor() * (
+            np.nanmean(self._returns_matrix, axis=0)
+        )
+
+        # each asset views its own column of the returns
         self.__assets = {
-            name: Asset(name=name, price_history=historical_prices[name])
-            for name in historical_prices.columns
+            name: Asset(
+                name=name,
+                price_history=historical_prices[name],
+                returns_history=returns[:, i],
+            )
+            for i, name in enumerate(historical_prices.columns)
         }
-        self.covariance_matrix = Asset.covariance_matrix(tuple(self))
-        self.asset_expected_returns = fromiter(
-            self.asset_expected_returns(), dtype=float
-        )
-        self.asset_expected_vol = fromiter(
-            self.asset_expected_volatility(), dtype=float
+        self.covariance_matrix = Asset.returns_covariance_matrix(
+            self._returns_matrix
         )
+        # upper triangular factor U with cov(R) = U'U for quadratic forms
+        try:
+            self._chol = cholesky(self.covariance_matrix, lower=False)
+        except (LinAlgError, ValueError):
+            # covariance is only positive semi-definite, e.g more assets
+            # than observations or a constant or duplicated price series,
+            # or has nans when an asset shares no dates with the others
+            self._chol = None
+        self.asset_expected_vol = sqrt(diag(self.covariance_matrix))
 
         self.security_count = len(self.__assets)
         self.risk_free_rate = risk_free_rate
@@ -80,15 +143,6 @@ class Harry:
         """
         return self.__assets[name]
 
-    def asset_expected_returns(self):
-        """gets expected return of each asset in portfolio
-        Yields
-        -------
-        Iterator[float]
-            an iteration of expected return of each asset in portfolio
-        """
-        yield from (asset.expected_returns for asset in self)
-
     def asset_expected_volatility(self):
         """gets expected volatility of each asset in portfolio
         Yields
@@ -96,10 +150,10 @@ class Harry:
         Iterator[float]
             iteration of expected vol of each asset scaled by trading days
         """
-        yield from sqrt(diag(self.covariance_matrix))
+        yield from self.asset_expected_vol
 
     @classmethod
-    def random_weights(cls, nsim: int, nsec: int):
+    def random_weights(cls, nsim: int, nsec: int, rng=None):
         """creates a portfolio with random weights
         Parameters
         ----------
@@ -107,18 +161,16 @@ class Harry:
             number of securities in porfolio
         nsim : int, optional, default=1
             number of simulations to perform
+        rng : np.random.Generator, optional, default=None
+            random generator to draw from, module generator if None
         Returns
         -------
         np.ndarray, shape=(nsim, nsec)
             random weight matrix
         """
-        if nsim == 1:
-            weights = random(nsec)
-            weights /= weights.sum()
-        else:
-            weights = random((nsim, nsec))
-            weights = (weights.T / weights.sum(axis=1)).T
-
+        rng = _rng if rng is None else rng
+        weights = rng.random(nsec if nsim == 1 else (nsim, nsec))
+        weights /= weights.sum(axis=-1, keepdims=True)
         return weights
 
     def portfolio_variance(self, weights: np.ndarray):
@@ -139,10 +191,22 @@ class Harry:
             portfolio variance
         """
         ndim = weights.ndim
+        if self._chol is None:
+            if ndim == 1:
+                return weights @ self.covariance_matrix @ weights
+            # only the diagonal of w @ cov @ w.T is needed
+            return np.einsum(
+                "pi,ij,pj->p", weights, self.covariance_matrix, weights
+            )
+
+        # w'cov(R)w = ||Uw||^2 where U is the cholesky factor of cov(R)
         if ndim == 1:
-            return weights.T @ self.covariance_matrix @ weights
+            v = self._chol @ weights
+            return v @ v
         else:
-            return diag(weights @ self.covariance_matrix @ weights.T)
+            # only the diagonal of w @ cov @ w.T is needed
+            v = weights @ self._chol.T
+            return np.einsum("pi,pi->p", v, v)
 
     def portfolio_expected_return(self, weights: np.ndarray):
         ndim = weights.ndim
@@ -152,7 +216,7 @@ class Harry:
         else:
             return weights @ self.asset_expected_returns
 
-    def simulate_investment_opportunity_set(self, nportfolios: int):
+    def simulate_investment_opportunity_set(self, nportfolios: int, rng=None):
         """runs a monte-carlo simulation by generating random portfolios
 
         The random portfolios are generated by first generating random
@@ -162,32 +226,37 @@ class Harry:
 
         Parameters
         ----------
-        nsec : int
-            [description]
-        nportfolios : int, optional
-            [description], by default 1
+        nportfolios : int
+            number of random portfolios to simulate
+        rng : np.random.Generator, optional, default=None
+            random generator to draw weights from, module generator if None
+
+        Returns
+        -------
+        tuple
+            volatility and expected return of each simulated portfolio
         """
         nsec = self.security_count
-        weights = Harry.random_weights(nsim=nportfolios, nsec=nsec)
+        weights = Harry.random_weights(nsim=nportfolios, nsec=nsec, rng=rng)
 
-        # return volatility and mean of each simulation as a tuple
-        return (
-            (
-                np.sqrt(self.portfolio_variance(weights[p])),
-                self.portfolio_expected_return(weights[p]),
-            )
-            for p in range(nportfolios)
+        # compute variance and mean of every simulation in parallel
+        variances, means = _simulated_var_ret(
+            weights, self.covariance_matrix, self.asset_expected_returns
         )
+        return np.sqrt(variances), means
 
-    def graph_simulated_portfolios(self, nportfolios: int):
+    def graph_simulated_portfolios(self, nportfolios: int, rng=None):
         """plots the simulated portfolio
         Parameters
         ----------
         nportfolios : int
             [description]
+        rng : np.random.Generator, optional, default=None
+            random generator to draw weights from, module generator if None
         """
-        simulations = self.simulate_investment_opportunity_set(nportfolios)
-        xval, yval = zip(*simulations)
+        xval, yval = self.simulate_investment_opportunity_set(
+            nportfolios, rng=rng
+        )
 
         plt.scatter(xval, yval, marker="o", s=10, cmap="winter", alpha=0.35)
 
@@ -226,8 +295,32 @@ class Harry:
             self.portfolio_expected_return(weights) - self.risk_free_rate
         ) / np.sqrt(self.portfolio_variance(weights))
 
+    def _negative_sharpe_and_grad(self, weights: np.ndarray) -> tuple:
+        """Computes negative sharpe ratio and its gradient wrt weights
+
+        Parameters
+        ----------
+        weights : np.ndarray
+            percentage of each asset held in portfolio
+        Returns
+        -------
+        tuple
+            negative sharpe ratio and its gradient
+        """
+        # cov(R)w is shared between the variance and the gradient
+        sw = self.covariance_matrix @ weights
+        var = weights @ sw
+        vol = np.sqrt(var)
+        excess = weights @ self.asset_expected_returns - self.risk_free_rate
+        grad = (self.asset_expected_returns * vol - excess * sw / vol) / var
+        return -excess / vol, -grad
+
     def optimize_risk(
-        self, constraints: bool = False, target: float = None, bounds=None
+        self,
+        constraints: bool = False,
+        target: float = None,
+        bounds=None,
+        rng=None,
     ):
         """Computes the weights corresponding to minimum variance
         Parameters
@@ -236,16 +329,29 @@ class Harry:
             mean constraint
         target : float, optional, default=None
             target portfolio return if constraints is True
+        bounds : [type], optional, default=None
+            bound for each asset weight, if None the closed form
+            solution is used instead of numerical optimization
+        rng : np.random.Generator, optional, default=None
+            random generator for the initial guess, module generator if None
         Returns
         -------
         np.ndarray
             weights corresponding to minimum variance
         """
+        # without bounds, the minimum variance portfolio has closed form
+        if bounds is None:
+            return self.__global_minimum_variance(
+                mean_constraint=constraints, target=target
+            )
+
         # get count of assets in portfolio
         total_assets = self.security_count
 
         # make random guess
-        guess_weights = Harry.random_weights(nsim=1, nsec=total_assets)
+        guess_weights = Harry.random_weights(
+            nsim=1, nsec=total_assets, rng=rng
+        )
 
         # minimize risk subject to target level of return constraint
         if constraints:
@@ -271,26 +377,36 @@ class Harry:
         )["x"]
         return weights
 
-    def optimize_sharpe(self, bounds=None):
+    def optimize_sharpe(self, bounds=None, rng=None):
         """Return the weights corresponding to maximizing sharpe ratio
         The sharpe ratio is given by SRp = mu_p - mu_f / sigma_p
         subject to w'mu = mu_p
                    w'cov(R)w = var_p
                    s.t sum(weights) = 1
+
+        Parameters
+        ----------
+        bounds : [type], optional, default=None
+            bound for each asset weight
+        rng : np.random.Generator, optional, default=None
+            random generator for the initial guess, module generator if None
         """
         # get count of assets in portfolio
         total_assets = self.security_count
 
         # make random guess
-        guess_weights = Harry.random_weights(nsim=1, nsec=total_assets)
+        guess_weights = Harry.random_weights(
+            nsim=1, nsec=total_assets, rng=rng
+        )
 
         # set target return & target variance and sum of weights constraint
         consts = [{"type": "eq", "fun": lambda w: sum(w) - 1}]
 
         # maximize sharpe subject to above constraints
         weights = minimize(
-            fun=lambda w: -1 * self.sharpe_ratio(w),
+            fun=self._negative_sharpe_and_grad,
             x0=guess_weights,
+            jac=True,
             constraints=consts,
             method="SLSQP",
             bounds=bounds,
@@ -298,36 +414,73 @@ class Harry:
 
         return weights
 
-    def construct_efficient_frontier(self, bounds=None):
-        """Constructs the efficient frontier
+    def _two_fund_portfolios(self, bounds=None, targets=None, rng=None):
+        """Computes frontier portfolios via the two fund theorem
+
+        Every frontier portfolio z = theta * m + (1 - theta) * x is a
+        linear combination of the global minimum variance portfolio m
+        and any other frontier portfolio x, here the one whose target
+        return is the max security return
 
         Parameters
         ----------
         bounds : [type], optional, default=None
-            bound for each asset weight
-            for long position, bound is (0, 1)
-            for short position, bound is (-1, 0)
+            bound for each asset weight when solving for m and x
+        targets : np.ndarray, optional, default=None
+            target returns of the combinations, if None theta is
+            a grid over [-1, 1]
+        rng : np.random.Generator, optional, default=None
+            random generator for the initial guesses when bounded
 
         Returns
         -------
         tuple
-            efficient portfolio's volatility and expected returns
+            minimum variance portfolio and weights of the combinations
         """
         # get minimum variance portfolio
-        m = self.optimize_risk(bounds=bounds)
-
-        # compute mean of global minimum variance portfolio
-        minimum_var_portfolio_mean = self.portfolio_expected_return(m)
+        m = self.optimize_risk(bounds=bounds, rng=rng)
 
         # get efficient portfolio x whose target return is max security returns
         target = self.asset_expected_returns.max()
-        x = self.optimize_risk(constraints=True, target=target, bounds=bounds)
+        x = self.optimize_risk(
+            constraints=True, target=target, bounds=bounds, rng=rng
+        )
 
         # compute grid of values
-        theta = np.linspace(-1, 1, 1000)
+        if targets is None:
+            theta = np.linspace(-1, 1, 1000)
+        else:
+            # portfolio return is affine in theta, so invert it
+            mu_m = self.portfolio_expected_return(m)
+            mu_x = self.portfolio_expected_return(x)
+            theta = (targets - mu_x) / (mu_m - mu_x)
 
         # portfolio z is linear combination of above two portfolios
-        z = theta[:, np.newaxis] * m + (1 - theta[:, np.newaxis]) * x
+        theta = theta[:, np.newaxis]
+        return m, theta * m + (1 - theta) * x
+
+    def construct_efficient_frontier(self, bounds=None, rng=None):
+        """Constructs the efficient frontier
+
+        Parameters
+        ----------
+        bounds : [type], optional, default=None
+            bound for each asset weight
+            for long position, bound is (0, 1)
+            for short position, bound is (-1, 0)
+        rng : np.random.Generator, optional, default=None
+            random generator for the initial guesses when bounded
+
+        Returns
+        -------
+        tuple
+            efficient portfolio's volatility and expected returns
+        """
+        # get minimum variance portfolio m and combinations z with portfolio x
+        m, z = self._two_fund_portfolios(bounds=bounds, rng=rng)
+
+        # compute mean of global minimum variance portfolio
+        minimum_var_portfolio_mean = self.portfolio_expected_return(m)
 
         # compute portfolio mean and variance with above weights
         efficient_portfolio_mean = self.portfolio_expected_return(z)
@@ -348,7 +501,7 @@ class Harry:
 
         return sig_p[sig_p <= vol], mu_p[sig_p <= vol]
 
-    def graph_frontier(self, nportfolios: int, bounds=None):
+    def graph_frontier(self, nportfolios: int, bounds=None, rng=None):
         """graphs the efficient frontier set
 
         Parameters
@@ -357,26 +510,45 @@ class Harry:
             [description]
         bounds : [type], optional
             [description], by default None
+        rng : np.random.Generator, optional, default=None
+            random generator shared by the simulation and the optimizer
         """
         plt.figure(figsize=(8, 5))
-        self.graph_simulated_portfolios(nportfolios)
+        self.graph_simulated_portfolios(nportfolios, rng=rng)
 
         # construct the frontier
-        xval, yval = self.construct_efficient_frontier(bounds=bounds)
+        xval, yval = self.construct_efficient_frontier(bounds=bounds, rng=rng)
         plt.plot(xval, yval, color="orange", linewidth=4)
         plt.grid()
 
-    def graph_investment_opportunity_set(self, bounds=None):
-        # create grid of target returns > minimum variance portfolio mean
+    def graph_investment_opportunity_set(self, bounds=None, rng=None):
+        """graphs the minimum variance frontier
+
+        Without bounds, the frontier portfolios for each target return
+        follow from the two fund theorem, so only two optimizations are
+        needed. The theorem does not hold under bounds, in which case
+        each target return is solved for separately
+
+        Parameters
+        ----------
+        bounds : [type], optional, default=None
+            bound for each asset weight
+        rng : np.random.Generator, optional, default=None
+            random generator for the initial guesses when bounded
+        """
+        # create grid of target returns
         target_returns = np.linspace(0, 1, 1000)
-        # todo: this can be made faster
-        weights = map(
-            lambda x: self.optimize_risk(
-                constraints=True, target=x, bounds=bounds
-            ),
-            target_returns,
-        )
-        weights = np.vstack(tuple(weights))
+        if bounds is None:
+            _, weights = self._two_fund_portfolios(targets=target_returns)
+        else:
+            weights = np.vstack(
+                [
+                    self.optimize_risk(
+                        constraints=True, target=target, bounds=bounds, rng=rng
+                    )
+                    for target in target_returns
+                ]
+            )
 
         # get expected returns and vols
         portfolio_expected_returns = self.portfolio_expected_return(weights)
@@ -396,18 +568,48 @@ class Harry:
         """computes weights associated with global minimum variance
 
         This function uses the formula for global minimum variance
-        # subject to constraint w'1 = 1
+        # subject to constraint w'1 = 1, given by
+        # w = cov(R)^-1 1 / 1'cov(R)^-1 1
         # if mean constraint is true, then another constraint is added
-        # w'mu = target
+        # w'mu = target, and w = l1 cov(R)^-1 1 + l2 cov(R)^-1 mu
+        # where the lagrange multipliers l1, l2 solve a 2x2 system
+        # if cov(R) is singular, the bordered kkt system is solved
+        # in the least squares sense instead
+        """
+        if self._chol is None:
+            return self.__kkt_least_squares(mean_constraint, target)
+
+        # cov(R)^-1 1 via the cached cholesky factor
+        ones = np.ones(self.security_count)
+        sinv1 = cho_solve((self._chol, False), ones)
+        if mean_constraint is False:
+            return sinv1 / sinv1.sum()
+
+        mu = self.asset_expected_returns
+        sinvmu = cho_solve((self._chol, False), mu)
+        A = np.array([[sinv1.sum(), sinvmu.sum()], [mu @ sinv1, mu @ sinvmu]])
+        b = np.array([1.0, target])
+        _, _, lagrange, info = _gesv(A, b, overwrite_a=1, overwrite_b=1)
+        if info > 0:
+            raise np.linalg.LinAlgError("Singular matrix")
+        return lagrange[0] * sinv1 + lagrange[1] * sinvmu
+
+    def __kkt_least_squares(self, mean_constraint=False, target=None):
+        """solves the minimum variance kkt system via least squares
+
+        Used when cov(R) is only positive semi-definite, in which case
+        the bordered system may be singular but is still consistent
         """
-        n = self.size + 1 if mean_constraint is False else self.size + 2
+        size = self.security_count
+        n = size + 1 if mean_constraint is False else size + 2
         A = np.zeros((n, n))
-        ones = np.ones(self.size)
+        ones = np.ones(size)
         b = np.zeros(n)
-        A[: self.size, : self.size] = self.covmat * 2
-        A[-1, : self.size], A[: self.size, -1] = ones, ones
+        A[:size, :size] = self.covariance_matrix * 2
+        A[-1, :size], A[:size, -1] = ones, ones
         if mean_constraint is True:
-            A[-2, : self.size], A[: self.size, -2] = self.mu_vec.T, self.mu_vec
+            mu = self.asset_expected_returns
+            A[-2, :size], A[:size, -2] = mu, mu
             b[-2] = target
         b[-1] = 1
-        return np.linalg.solve(A, b)[: self.size]
+        return np.linalg.lstsq(A, b, rcond=None)[0][:size]